@@ -1,17 +1,42 @@
 import os
-import csv
+import time
+import random
+import asyncio
+import contextlib
 import logging
+import sqlite3
+import aiohttp
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+try:
+    from orjson import loads as json_loads
+except ImportError:  # Optional: faster decoding of message responses
+    from json import loads as json_loads
+
 # --- CONFIGURATION ---
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 CREDENTIALS_FILE = 'credentials.json'
 TOKEN_FILE = 'token.json'
+ACCOUNT_TOKEN_FILES = [TOKEN_FILE]  # One token file per Gmail account to export
 OUTPUT_FILE = 'emails.csv'
+CACHE_FILE_SUFFIX = '.cache.db'  # Each account caches next to its token, e.g. token.cache.db
+CACHE_TTL = 60 * 60  # Seconds; labelIds change as mail is read, archived or labelled
+GMAIL_API_URL = 'https://gmail.googleapis.com/gmail/v1/users/me'
+METADATA_HEADERS = ['Subject', 'From', 'To', 'Date']
+MESSAGE_FIELDS = 'id,threadId,labelIds,payload/headers'  # Partial response: only what we parse
+LIST_LABEL_IDS = ['INBOX']  # Narrow server-side so archived matches are never fetched
+PAGE_SIZE = 500  # Largest page messages.list will return
+KEEPALIVE_TIMEOUT = 60
+DNS_CACHE_TTL = 300
+MAX_CONCURRENCY = 20  # Keeps in-flight requests under the per-user quota
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+RETRY_STATUSES = {429, 503}
 
 # Configure Logging
 logging.basicConfig(
@@ -19,10 +44,44 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+def create_http_session(account_count=1):
+    """
+    Creates an aiohttp session with a pooled, keep-alive connector so TCP/TLS
+    handshakes are paid once per connection rather than once per request.
+    The pool is sized to every account's semaphore, so the per-account
+    semaphores alone decide concurrency.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONCURRENCY * account_count,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=DNS_CACHE_TTL
+    )
+    return aiohttp.ClientSession(connector=connector)
+
 class GmailService:
-    def __init__(self):
+    # Default job-application search, shared by all instances; override per call with get_emails(query=...)
+    QUERY = (
+        '('
+        'subject:("application for" OR "thank you for applying" OR '
+        '"application received" OR "interview" OR "assessment" OR '
+        '"offer" OR "regarding your application")'
+        ')'
+        ' AND '
+        '('
+        'from:(careers OR hr OR recruitment OR gov OR talent OR hiring)'
+        ')'
+        ' -subject:("job alert" OR "job alerts" OR "recommended jobs" OR "linkedin news")'
+    )
+
+    def __init__(self, token_file=TOKEN_FILE):
+        self.token_file = token_file
+        # Labels the account's rows in the CSV, since message IDs are only unique per mailbox
+        self.account = os.path.splitext(os.path.basename(token_file))[0]
         self.creds = None
         self.service = None
+        self._sem = None
+        # Message IDs are only unique within a mailbox, so each account gets its own cache
+        self.cache = self._open_cache(os.path.splitext(token_file)[0] + CACHE_FILE_SUFFIX)
         self.authenticate()
         
     def authenticate(self):
@@ -32,8 +91,8 @@ class GmailService:
         """
         try:
             # Load existing tokens if they exist
-            if os.path.exists(TOKEN_FILE):
-                self.creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+            if os.path.exists(self.token_file):
+                self.creds = Credentials.from_authorized_user_file(self.token_file, SCOPES)
 
             # Refresh or initiate new login if credentials are invalid/expired
             if not self.creds or not self.creds.valid:
@@ -49,113 +108,296 @@ class GmailService:
                     self.creds = flow.run_local_server(port=0)
 
                 # Save the credentials for the next run
-                with open(TOKEN_FILE, 'w') as token:
+                with open(self.token_file, 'w') as token:
                     token.write(self.creds.to_json())
 
-            self.service = build('gmail', 'v1', credentials=self.creds)
+            # Recent googleapiclient 2.x already defaults to its bundled discovery document;
+            # the flag only pins that default
+            self.service = build('gmail', 'v1', credentials=self.creds, static_discovery=True)
             logging.info("Gmail API Service initialized successfully.")
 
         except Exception as e:
             logging.error(f"Authentication Failed: {e}")
             raise
 
-    def get_emails(self, max_results=100):
+    @staticmethod
+    def _open_cache(cache_file):
+        """
+        Opens the local metadata cache. Headers never change for a message ID, but
+        labelIds do, so entries older than CACHE_TTL are treated as misses.
+        """
+        conn = sqlite3.connect(cache_file)
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS meta('
+            'id TEXT PRIMARY KEY, subject TEXT, from_ TEXT, to_ TEXT, '
+            'date TEXT, label_ids TEXT, thread_id TEXT, fetched_at REAL)'
+        )
+        # Caches created before fetched_at existed: their rows read as stale (NULL)
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(meta)')}
+        if 'fetched_at' not in columns:
+            conn.execute('ALTER TABLE meta ADD COLUMN fetched_at REAL')
+        return conn
+
+    def _load_cached(self, msg_ids):
+        """
+        Returns cached rows fetched within CACHE_TTL for the given message IDs, keyed by ID.
+        Rows are in CSV column order: id, threadId, labelIds, subject, from, to, date.
+        """
+        cached = {}
+        fresh_after = time.time() - CACHE_TTL
+        # Chunked to stay under SQLite's bound-parameter limit
+        for i in range(0, len(msg_ids), 500):
+            chunk = msg_ids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            cursor = self.cache.execute(
+                'SELECT id, thread_id, label_ids, subject, from_, to_, date '
+                f'FROM meta WHERE id IN ({placeholders}) AND fetched_at >= ?',
+                [*chunk, fresh_after]
+            )
+            for row in cursor:
+                cached[row[0]] = row
+        return cached
+
+    def _save_cached(self, rows):
+        """
+        Stores freshly fetched rows (in CSV column order) in a single transaction.
+        """
+        fetched_at = time.time()
+        with self.cache:
+            self.cache.executemany(
+                'INSERT OR REPLACE INTO meta(id, thread_id, label_ids, subject, from_, to_, date, fetched_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(*row, fetched_at) for row in rows]
+            )
+
+    def iter_messages(self, query, total=None):
+        """
+        Yields message stubs (id and threadId) matching the query, following
+        nextPageToken until the results or the requested total run out.
+        """
+        request = self.service.users().messages().list(
+            userId='me',
+            q=query,
+            labelIds=LIST_LABEL_IDS,
+            includeSpamTrash=False,
+            maxResults=min(total, PAGE_SIZE) if total else PAGE_SIZE
+        )
+        remaining = total
+
+        while request is not None and remaining != 0:
+            results = request.execute()
+            page = results.get('messages', [])[:remaining]
+            yield from page
+
+            if remaining is not None:
+                remaining -= len(page)
+            request = self.service.users().messages().list_next(request, results)
+
+    def get_emails(self, max_results=100, query=None):
         """
         Fetches a list of messages from the user's account.
+        Pass max_results=None to page through every matching message, and
+        query to override the default job-application search.
         """
         if not self.service:
             raise Exception("Gmail service not initialized. Call authenticate() first.")
         
+        messages = []
         try:
-            logging.info(f"Fetching last {max_results} messages...")
-            
-            query = (
-    '('
-    'subject:("application for" OR "thank you for applying" OR '
-    '"application received" OR "interview" OR "assessment" OR '
-    '"offer" OR "regarding your application")'
-    ')'
-    ' AND '
-    '('
-    'from:(careers OR hr OR recruitment OR gov OR talent OR hiring)'
-    ')'
-    ' -subject:("job alert" OR "job alerts" OR "recommended jobs" OR "linkedin news")'
-)
-            results = self.service.users().messages().list(userId='me', maxResults=max_results,q= query).execute()
-            return results.get('messages', [])
+            logging.info(f"Fetching last {max_results or 'all'} messages...")
+            messages.extend(self.iter_messages(query or self.QUERY, total=max_results))
         except HttpError as error:
             logging.error(f"An HTTP error occurred: {error}")
-            return []
+        return messages
+
+    async def _fetch(self, session, msg_id):
+        """
+        Retrieves metadata for a single message over the Gmail REST API.
+        """
+        params = [('format', 'metadata'), ('fields', MESSAGE_FIELDS)]
+        params += [('metadataHeaders', h) for h in METADATA_HEADERS]
+        headers = {'Authorization': f'Bearer {self.creds.token}'}
+
+        async with self._sem:
+            for attempt in range(MAX_ATTEMPTS):
+                try:
+                    async with session.get(f'{GMAIL_API_URL}/messages/{msg_id}', params=params, headers=headers) as resp:
+                        if resp.status in RETRY_STATUSES and attempt < MAX_ATTEMPTS - 1:
+                            delay = self._backoff_delay(attempt, resp.headers.get('Retry-After'))
+                            logging.info(f"Rate limited on message {msg_id} ({resp.status}), retrying in {delay:.1f}s...")
+                        else:
+                            resp.raise_for_status()
+                            return msg_id, json_loads(await resp.read())
+                except asyncio.TimeoutError:
+                    if attempt == MAX_ATTEMPTS - 1:
+                        logging.warning(f"Could not retrieve message {msg_id}: timed out")
+                        return msg_id, None
+                    delay = self._backoff_delay(attempt)
+                    logging.info(f"Timed out on message {msg_id}, retrying in {delay:.1f}s...")
+                except (aiohttp.ClientError, ValueError) as error:
+                    logging.warning(f"Could not retrieve message {msg_id}: {error}")
+                    return msg_id, None
+
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def _backoff_delay(attempt, retry_after=None):
+        """
+        Jittered exponential backoff, honouring the server's Retry-After hint.
+        """
+        delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(int(retry_after), BACKOFF_MAX))
+        return delay + random.uniform(0, delay / 2)
+
+    async def _fetch_all(self, messages, session=None):
+        """
+        Fetches metadata for all messages concurrently over a shared connection pool.
+        A new session is opened unless one is passed in to share across accounts.
+        """
+        # Created per run since a semaphore is bound to the event loop that uses it;
+        # being per instance, it also gives each account its own quota budget
+        self._sem = asyncio.Semaphore(MAX_CONCURRENCY)
+        owned = create_http_session() if session is None else contextlib.nullcontext(session)
+        async with owned as session:
+            results = await asyncio.gather(*(self._fetch(session, m['id']) for m in messages))
+        return {msg_id: msg_data for msg_id, msg_data in results if msg_data}
+
+    def _refresh_token(self):
+        """
+        Refreshes the access token up front so it cannot expire while requests are in flight.
+        """
+        if not self.creds.valid and self.creds.refresh_token:
+            logging.info("Refreshing expired access token...")
+            self.creds.refresh(Request())
+
+    @staticmethod
+    def _write_rows(csv_file, rows):
+        """
+        Writes rows as pre-encoded UTF-8 bytes to a file opened in binary mode.
+        id and threadId are hex and labelIds are uppercase label IDs, so only the
+        account and free-text columns need their quotes doubled; those are always quoted.
+        """
+        csv_file.writelines(
+            ('"%s",%s,%s,"%s","%s","%s","%s","%s"\r\n' % (
+                row[0].replace('"', '""'),
+                row[1],
+                row[2],
+                row[3],
+                row[4].replace('"', '""'),
+                row[5].replace('"', '""'),
+                row[6].replace('"', '""'),
+                row[7].replace('"', '""')
+            )).encode('utf-8')
+            for row in rows
+        )
 
-    def get_message_details(self, msg_id):
+    async def collect_rows(self, messages, session=None):
         """
-        Retrieves metadata for a specific message ID.
+        Parses headers into CSV rows, led by the account name, in the order the messages were listed.
+        Previously seen messages are served from the local cache.
         """
         if not self.service:
             raise Exception("Gmail service not initialized.")
-        
-        try:
-            msg = self.service.users().messages().get(
-                userId='me',
-                id=msg_id,
-                format='metadata',
-                metadataHeaders=['Subject', 'From', 'To', 'Date']
-            ).execute()
-            return msg
-        except HttpError as error:
-            logging.warning(f"Could not retrieve message {msg_id}: {error}")
-            return None
 
-    def process_and_save(self, messages):
+        cached = self._load_cached([m['id'] for m in messages])
+        misses = [m for m in messages if m['id'] not in cached]
+        logging.info(f"{len(cached)} messages cached, fetching {len(misses)}...")
+
+        details = {}
+        if misses:
+            await asyncio.to_thread(self._refresh_token)
+            details = await self._fetch_all(misses, session)
+
+        fetched = {}
+
+        for message in misses:
+            msg_id = message['id']
+            msg_data = details.get(msg_id)
+            
+            if not msg_data:
+                continue
+
+            # Index headers once so each lookup is a dict hit rather than a scan
+            headers = {h['name']: h['value'] for h in msg_data.get('payload', {}).get('headers', [])}
+
+            fetched[msg_id] = (
+                msg_id,
+                message.get('threadId', ''),
+                ','.join(msg_data.get('labelIds', [])),
+                headers.get('Subject', 'N/A'),
+                headers.get('From', 'N/A'),
+                headers.get('To', 'N/A'),
+                headers.get('Date', 'N/A')
+            )
+
+        self._save_cached(fetched.values())
+
+        rows = (cached.get(m['id']) or fetched.get(m['id']) for m in messages)
+        return [(self.account, *row) for row in rows if row]
+
+    @classmethod
+    def save_csv(cls, rows):
         """
-        Parses headers and saves data to CSV with error handling for file IO.
+        Saves rows to CSV with error handling for file IO.
         """
-        fieldnames = ['id', 'threadId', 'labelIds', 'subject', 'from', 'to', 'date']
+        fieldnames = ['account', 'id', 'threadId', 'labelIds', 'subject', 'from', 'to', 'date']
         
         try:
-            with open(OUTPUT_FILE, mode='w', newline='', encoding='utf-8') as csv_file:
-                writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-                writer.writeheader()
-
-                for message in messages:
-                    msg_id = message['id']
-                    msg_data = self.get_message_details(msg_id)
-                    
-                    if not msg_data:
-                        continue
-
-                    headers = msg_data.get('payload', {}).get('headers', [])
-                    
-                    # Helper function to extract specific header values safely
-                    def get_header(name):
-                        return next((h['value'] for h in headers if h['name'] == name), 'N/A')
-
-                    writer.writerow({
-                        'id': msg_id,
-                        'threadId': message.get('threadId'),
-                        'labelIds': ','.join(msg_data.get('labelIds', [])),
-                        'subject': get_header('Subject'),
-                        'from': get_header('From'),
-                        'to': get_header('To'),
-                        'date': get_header('Date')
-                    })
+            with open(OUTPUT_FILE, mode='wb') as csv_file:
+                csv_file.write((','.join(fieldnames) + '\r\n').encode('utf-8'))
+                cls._write_rows(csv_file, rows)
             logging.info(f"Successfully saved data to {OUTPUT_FILE}")
             
         except IOError as e:
             logging.error(f"File Error: Could not write to {OUTPUT_FILE}. Is it open in another program? {e}")
 
+    def process_and_save(self, messages):
+        """
+        Parses headers and saves data to CSV.
+        """
+        self.save_csv(asyncio.run(self.collect_rows(messages)))
+
+async def export_accounts(accounts, max_results=100):
+    """
+    Lists and fetches messages for several accounts concurrently over one shared
+    HTTP session, then writes every account's rows to a single CSV.
+    """
+    async def run_one(account):
+        # A failing account is logged and skipped so the others still get written
+        try:
+            # messages.list goes through googleapiclient, which blocks, so keep it off the loop
+            messages = await asyncio.to_thread(account.get_emails, max_results)
+            return await account.collect_rows(messages, session) if messages else []
+        except Exception as e:
+            logging.error(f"Export failed for account {account.token_file}: {e}")
+            return []
+
+    async with create_http_session(len(accounts)) as session:
+        results = await asyncio.gather(*(run_one(account) for account in accounts))
+
+    rows = [row for account_rows in results for row in account_rows]
+    if not rows:
+        logging.info("No messages found.")
+        return
+
+    GmailService.save_csv(rows)
+
 def main():
-    gmail_app = GmailService()
+    accounts = []
+    for token_file in ACCOUNT_TOKEN_FILES:
+        # Authentication refreshes or logs in here, so a bad token only skips its own account
+        try:
+            accounts.append(GmailService(token_file))
+        except Exception as e:
+            logging.error(f"Skipping account {token_file}: {e}")
+
+    if not accounts:
+        logging.critical("Application failed: no account could be authenticated.")
+        return
     
     try:
-        gmail_app.authenticate()
-        messages = gmail_app.get_emails(max_results=10)
-        
-        if not messages:
-            logging.info("No messages found.")
-            return
-
-        gmail_app.process_and_save(messages)
+        asyncio.run(export_accounts(accounts, max_results=10))
         
     except Exception as e:
         logging.critical(f"Application failed: {e}")